@@ -1,8 +1,13 @@
 import argparse
 import re
-from io import StringIO
-from os import walk
-from os.path import join, isdir
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from errno import EACCES
+from functools import lru_cache, partial
+from mmap import mmap, ACCESS_READ
+from os import access, cpu_count, fstat, remove, replace, scandir, strerror, W_OK
+from os.path import basename, dirname, exists, isdir, realpath
+from shutil import copymode
+from tempfile import mkstemp
 
 
 # Copyright (c) 2017, 2018 Jason W. Ross
@@ -27,11 +32,39 @@ from os.path import join, isdir
 
 # Initially described at https://softwarepragmatism.com
 
+# The version attributes that are updated by default, and the precompiled regular expression used to find both of them
+# at once; the patterns for individual attributes are compiled by _version_regex. Each pattern starts with the literal
+# '[assembly:' so that the regular expression engine can skip quickly to the possible matches. Matches that are not at
+# the start of a line, such as those in comments, are discarded afterwards. Only the build number is captured, as that
+# is the only part of the version that is replaced.
+_VERSION_NAMES = ('AssemblyVersion', 'AssemblyFileVersion')
+_ALL_VERSIONS_REGEX = re.compile(rb'\[assembly:\s*(?:' + '|'.join(_VERSION_NAMES).encode('ascii') +
+                                 rb')\(\"\d+\.\d+\.(?P<middle>\d+)\.\d+\"\)')
+
+# The names of directories that are not searched by default. These contain build output, packages and tool data,
+# including generated copies of AssemblyInfo files that should not be updated.
+_DEFAULT_EXCLUDED_DIRECTORIES = frozenset(('bin', 'obj', 'packages', '.git', '.vs', 'node_modules'))
+
+# The total number of threads used to update files concurrently, across all of the worker processes.
+_MAX_THREADS = min(32, (cpu_count() or 1) * 4)
+
+
+@lru_cache(maxsize=8)
+def _version_regex(version_name):
+    """Compile the regular expression used to find the given version attribute, caching it for later calls.
+
+    :param version_name: The name of the version attribute, e.g. 'AssemblyVersion' or 'AssemblyFileVersion'.
+    :return: The compiled regular expression.
+    """
+    return re.compile(rb'\[assembly:\s*' + re.escape(version_name.encode('ascii')) +
+                      rb'\(\"\d+\.\d+\.(?P<middle>\d+)\.\d+\"\)')
+
 
 class VersionNumberUpdater:
 
     @staticmethod
-    def find_assembly_info_files(root_directory, file_ending='AssemblyInfo.cs'):
+    def find_assembly_info_files(root_directory, file_ending='AssemblyInfo.cs',
+                                 excluded_directories=_DEFAULT_EXCLUDED_DIRECTORIES):
         """Iterates through the directory structure starting at the root and searching for files that may contain the
         version definitions for the solution.
 
@@ -41,64 +74,213 @@ class VersionNumberUpdater:
         for version definitions.
         As most C# projects either contain a file called 'AssemblyInfo.cs', or refer to a common file called
         'CommonAssemblyInfo.cs', this argument defaults to 'AssemblyInfo.cs' to match both names.
-        :return: A collection of paths of files which should be checked for version specifications.
+        :param excluded_directories: The names of subdirectories that will not be searched, along with their contents.
+        This defaults to the build output, package and tool directories: 'bin', 'obj', 'packages', '.git', '.vs' and
+        'node_modules'.
+        :return: A collection of paths of files which should be checked for version specifications, sorted so that the
+        results do not depend upon the order in which the file system returns directory entries.
         """
         files_to_check = []
-        for root, directories, files in walk(root_directory):
-            for file_to_check in [filename for filename in files if filename.endswith(file_ending)]:
-                files_to_check.append(join(root, file_to_check))
+        VersionNumberUpdater._scan_directory(root_directory, file_ending, frozenset(excluded_directories),
+                                             files_to_check, skip_unreadable=False)
 
-        return files_to_check
+        return tuple(sorted(files_to_check))
 
     @staticmethod
-    def update_version_numbers(file_paths, version_name, build_number):
+    def _scan_directory(directory, file_ending, excluded_directories, files_to_check, skip_unreadable=True):
+        """Recursively scan a directory, adding the paths of any files with the given ending to the collection.
+
+        The directory entries returned by scandir usually know their own type, so this avoids a stat call for each
+        entry in the tree. As with os.walk, each directory is closed before its subdirectories are scanned, and
+        subdirectories that cannot be read are skipped.
+
+        :param directory: The directory to be scanned, along with all of its subdirectories.
+        :param file_ending: The ending of the file names that will be added to the collection.
+        :param excluded_directories: The names of subdirectories that will not be scanned.
+        :param files_to_check: The collection that the paths of matching files are added to.
+        :param skip_unreadable: Whether the directory is silently skipped if it cannot be read. If this is False, the
+        error is raised instead.
+        """
+        try:
+            directory_entries = scandir(directory)
+        except OSError:
+            if skip_unreadable:
+                return
+            raise
+
+        subdirectories = []
+        with directory_entries:
+            for entry in directory_entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in excluded_directories:
+                        subdirectories.append(entry.path)
+                elif entry.name.endswith(file_ending):
+                    files_to_check.append(entry.path)
+
+        for subdirectory in subdirectories:
+            VersionNumberUpdater._scan_directory(subdirectory, file_ending, excluded_directories, files_to_check)
+
+    @staticmethod
+    def update_version_numbers(file_paths, version_name, build_number, jobs=1):
         """Iterate through all of the given files, updating the version numbers contained within them.
 
         :param file_paths: A collection of paths of files which are to be checked for version specifications.
         :param version_name: Either 'AssemblyVersion' or 'AssemblyFileVersion' depending upon which of the Windows
         version attributes you want to change.
         :param build_number: The new build number to be placed into the overall version number.
+        :param jobs: The number of worker processes that the files are divided between. The default of 1 updates the
+        files in the current process.
         :return: The paths of the file(s) that were updated.
         """
+        return VersionNumberUpdater._update_files(file_paths, _version_regex(version_name),
+                                                  (version_name.encode('ascii'),), build_number, jobs)
 
-        version_pattern = '(?P\s*\[assembly\:' + \
-                          version_name + \
-                          '\(\"\d+\.\d+\.)(?P\d+)(?P\.\d+\"\))'
-        version_regex = re.compile(version_pattern)
-        updated_file_paths = []
+    @staticmethod
+    def update_all_version_numbers(file_paths, build_number, jobs=1):
+        """Iterate through all of the given files, updating both the AssemblyVersion and AssemblyFileVersion numbers
+        contained within them in a single pass.
 
-        # Get the contents of each of the files, and update the version numbers.
-        for file_path in file_paths:
-            version_updated = False
+        :param file_paths: A collection of paths of files which are to be checked for version specifications.
+        :param build_number: The new build number to be placed into the overall version number.
+        :param jobs: The number of worker processes that the files are divided between. The default of 1 updates the
+        files in the current process.
+        :return: The paths of the file(s) that were updated.
+        """
+        return VersionNumberUpdater._update_files(file_paths, _ALL_VERSIONS_REGEX,
+                                                  tuple(name.encode('ascii') for name in _VERSION_NAMES), build_number,
+                                                  jobs)
 
-            # Create a memory buffer for the file.
-            with StringIO() as buffer_file:
+    @staticmethod
+    def _update_files(file_paths, version_regex, version_names, build_number, jobs):
+        """Iterate through all of the given files, updating the version numbers matched by the regular expression.
 
-                # Read the source file into memory - there should be plenty of space.
-                with open(file_path, mode='r') as file_object:
-                    for line_number, line_contents in enumerate(file_object):
+        :param file_paths: A collection of paths of files which are to be checked for version specifications.
+        :param version_regex: The compiled regular expression used to find the version specifications.
+        :param version_names: The encoded names of the version attributes matched by the regular expression. Files
+        that contain none of these names are skipped without being searched by the regular expression.
+        :param build_number: The new build number to be placed into the overall version number.
+        :param jobs: The number of worker processes that the files are divided between.
+        :return: The paths of the file(s) that were updated.
+        """
+        # The threads used for the file I/O are shared out between the processes, rather than each process having its
+        # own full set of threads competing for the same disk.
+        jobs = max(1, jobs)
+        update_file_slice = partial(VersionNumberUpdater._update_file_slice, version_regex=version_regex,
+                                    version_names=version_names, build_number=str(build_number).encode('ascii'),
+                                    max_threads=max(1, _MAX_THREADS // jobs))
+
+        if jobs == 1:
+            return update_file_slice(file_paths)
 
-                        # Update the version numbers as the file contents are put into the memory file.
-                        match = version_regex.match(line_contents)
+        # Divide the files into one contiguous slice per process, so the results stay in the order of the files.
+        file_paths = tuple(file_paths)
+        slice_size = max(1, -(-len(file_paths) // jobs))
+        file_slices = [file_paths[start:start + slice_size] for start in range(0, len(file_paths), slice_size)]
 
-                        if match:
-                            buffer_file.write(
-                                version_regex.sub(match.group('prefix') + str(build_number) + match.group('postfix'),
-                                                  line_contents))
-                            version_updated = True
-                        else:
-                            buffer_file.write(line_contents)
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return [file_path for updated_file_paths in executor.map(update_file_slice, file_slices)
+                    for file_path in updated_file_paths]
 
-                # Overwrite the original file with the contents of the memory buffer if the version was updated.
-                if version_updated:
-                    buffer_file.seek(0)
+    @staticmethod
+    def _update_file_slice(file_paths, version_regex, version_names, build_number, max_threads):
+        """Update the version numbers matched by the regular expression in each of the given files.
+
+        :param file_paths: A collection of paths of files which are to be checked for version specifications.
+        :param version_regex: The compiled regular expression used to find the version specifications.
+        :param version_names: The encoded names of the version attributes matched by the regular expression.
+        :param build_number: The encoded build number to be placed into each version number.
+        :param max_threads: The maximum number of threads used to update the files.
+        :return: The paths of the file(s) that were updated.
+        """
+        update_file = partial(VersionNumberUpdater._update_file, version_regex=version_regex,
+                              version_names=version_names, build_number=build_number)
 
-                    with open(file_path, mode='w') as file_object:
-                        file_object.writelines(buffer_file.readlines())
+        # Each file is independent of the others, so update them concurrently to overlap the file I/O.
+        with ThreadPoolExecutor(max_workers=max_threads) as executor:
+            return [file_path for file_path in executor.map(update_file, file_paths) if file_path is not None]
 
-                    updated_file_paths.append(file_path)
+    @staticmethod
+    def _update_file(file_path, version_regex, version_names, build_number):
+        """Update the version numbers matched by the regular expression in a single file.
+
+        :param file_path: The path of the file which is to be checked for version specifications.
+        :param version_regex: The compiled regular expression used to find the version specifications.
+        :param version_names: The encoded names of the version attributes matched by the regular expression.
+        :param build_number: The encoded build number to be placed into each version number.
+        :return: The path of the file if it was updated, otherwise None.
+        :raises PermissionError: If the file needs to be updated but is read-only, e.g. because it has not been checked
+        out of a version control system such as TFVC or Perforce.
+
+        Updated files are normally written to a temporary file which then replaces the original, so the updated file is
+        owned by the current user and any ACLs on the original file are not kept. Files with more than one hard link
+        are overwritten in place instead, so that all of the links see the update.
+        """
 
-        return updated_file_paths
+        # Map the source file into memory and update all of the version numbers in it at once. Empty files
+        # cannot be mapped, and cannot contain a version either.
+        with open(file_path, mode='rb') as file_object:
+            file_status = fstat(file_object.fileno())
+            if file_status.st_size == 0:
+                return None
+
+            with mmap(file_object.fileno(), 0, access=ACCESS_READ) as mapped_contents:
+                if all(mapped_contents.find(name) == -1 for name in version_names):
+                    return None
+
+                # Splice the build number in place of the build part of each version found, in a single scan.
+                # The versions may already contain the build number, in which case the file is left untouched.
+                contents_parts = []
+                version_changed = False
+                last_end = 0
+                for match in version_regex.finditer(mapped_contents):
+
+                    # Only update declarations preceded by nothing but whitespace on their line, so that versions in
+                    # comments are left alone.
+                    line_start = mapped_contents.rfind(b'\n', 0, match.start()) + 1
+                    if mapped_contents[line_start:match.start()].strip():
+                        continue
+
+                    build_start, build_end = match.span('middle')
+                    contents_parts.append(mapped_contents[last_end:build_start])
+                    contents_parts.append(build_number)
+                    version_changed = version_changed or mapped_contents[build_start:build_end] != build_number
+                    last_end = build_end
+
+                if not version_changed:
+                    return None
+
+                contents_parts.append(mapped_contents[last_end:])
+                new_contents = b''.join(contents_parts)
+
+        # The path is resolved so that a symbolic link is written through to its target, rather than being replaced by a
+        # regular file. Replacing the file would ignore its own permissions, so refuse to update read-only files.
+        real_file_path = realpath(file_path)
+        if not access(real_file_path, W_OK):
+            raise PermissionError(EACCES, strerror(EACCES), file_path)
+
+        # Replacing a file with more than one hard link would split it from its other links, so overwrite it in place.
+        if file_status.st_nlink > 1:
+            with open(real_file_path, mode='wb') as file_object:
+                file_object.write(new_contents)
+
+            return file_path
+
+        # Write the updated contents to a new temporary file alongside the original, then replace the original with it.
+        # An interruption therefore cannot leave a partially written file behind.
+        temporary_file_descriptor, temporary_file_path = mkstemp(prefix=basename(real_file_path) + '.', suffix='.tmp',
+                                                                 dir=dirname(real_file_path))
+        try:
+            with open(temporary_file_descriptor, mode='wb') as file_object:
+                file_object.write(new_contents)
+
+            copymode(real_file_path, temporary_file_path)
+            replace(temporary_file_path, real_file_path)
+        except BaseException:
+            if exists(temporary_file_path):
+                remove(temporary_file_path)
+            raise
+
+        return file_path
 
 
 def main():
@@ -125,6 +307,21 @@ def main():
                              'data. This is usually ''AssemblyInfo.cs'', but may be ''CommonAssemblyInfo.cs''. '
                              'The default value is ''AssemblyInfo.cs''.',
                         default='AssemblyInfo.cs')
+    parser.add_argument('-x', '--exclude-dir',
+                        help='The name of a directory that will not be searched, in addition to the default '
+                             'excluded directories. This option can be given more than once. The default excluded '
+                             'directories are: ' + ', '.join(sorted(_DEFAULT_EXCLUDED_DIRECTORIES)) + '.',
+                        action='append', dest='excludedirs', default=None)
+    parser.add_argument('--no-default-excludes',
+                        help='Search the default excluded directories as well, so that only the directories given '
+                             'with --exclude-dir are excluded.',
+                        action='store_true', dest='nodefaultexcludes')
+    parser.add_argument('-j', '--jobs',
+                        help='The number of processes used to update the files. This is only worth increasing for '
+                             'directories containing very large numbers of files. The threads used to read and write '
+                             'the files are divided between the processes, so increasing this does not increase the '
+                             'total number of threads. The default value is 1.',
+                        type=int, default=1)
 
     args = parser.parse_args()
 
@@ -139,27 +336,36 @@ def main():
         raise ValueError('The build number must be larger than or equal to 0. The specified value was: ' +
                          str(args.buildnumber))
 
+    # Continue only if the number of jobs is valid
+    if args.jobs < 1:
+        raise ValueError('The number of jobs must be larger than or equal to 1. The specified value was: ' +
+                         str(args.jobs))
+
     # Set the remaining variables
     version_attribute_name = args.versionname
 
-    # Scan the directories and find the files to check
-    if args.fileending is None:
-        assembly_info_files = VersionNumberUpdater.find_assembly_info_files(directory_path)
+    if args.nodefaultexcludes:
+        excluded_directories = set()
     else:
-        assembly_info_files = VersionNumberUpdater.find_assembly_info_files(directory_path, args.fileending)
-
-    # Update the version attributes as required.
-    updated_files = []
-    if version_attribute_name in ['a', 'b']:
-        updated_files.extend(
-            VersionNumberUpdater.update_version_numbers(assembly_info_files, 'AssemblyVersion', args.buildnumber))
+        excluded_directories = set(_DEFAULT_EXCLUDED_DIRECTORIES)
 
-    if version_attribute_name in ['f', 'b']:
-        updated_files.extend(
-            VersionNumberUpdater.update_version_numbers(assembly_info_files, 'AssemblyFileVersion', args.buildnumber))
+    if args.excludedirs is not None:
+        excluded_directories.update(args.excludedirs)
 
-    # Get rid of duplicates - a file may have been updated twice, once for each version type:
-    updated_files = sorted(list(set(updated_files)))
+    # Scan the directories and find the files to check
+    assembly_info_files = VersionNumberUpdater.find_assembly_info_files(directory_path, args.fileending,
+                                                                        excluded_directories)
+
+    # Update the version attributes as required. Both attributes are updated in a single pass over the files.
+    if version_attribute_name == 'a':
+        updated_files = VersionNumberUpdater.update_version_numbers(assembly_info_files, 'AssemblyVersion',
+                                                                    args.buildnumber, args.jobs)
+    elif version_attribute_name == 'f':
+        updated_files = VersionNumberUpdater.update_version_numbers(assembly_info_files, 'AssemblyFileVersion',
+                                                                    args.buildnumber, args.jobs)
+    else:
+        updated_files = VersionNumberUpdater.update_all_version_numbers(assembly_info_files, args.buildnumber,
+                                                                        args.jobs)
 
     # Let the caller know what was updated
     print('The following files were updated with build number ' + str(args.buildnumber) + ':')
@@ -167,4 +373,6 @@ def main():
     print('Finished')
 
 
-main()
+# Worker processes import this module, so only run the script when it is executed directly.
+if __name__ == '__main__':
+    main()